@@ -10,7 +10,7 @@ def read(fname):
 long_description = read('README.rst')
 
 install_requires = [
-    'atproto>=0.0.29',
+    'atproto>=0.0.46',
     'coloredlogs>=10.0',
     'dateparser>=1.1.8',
     'Mastodon.py>=1.3.0',
@@ -21,7 +21,8 @@ install_requires = [
     'python-facebook-api>=0.17.1',
     'python-twitter>=3.4.0',
     'ronkyuu>=0.6',
-    'tweepy>=4.14.0'
+    'tweepy>=4.14.0',
+    'urllib3>=2.0.2'
 ]
 
 tests_require = [
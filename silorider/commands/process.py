@@ -42,8 +42,22 @@ class Processor:
 
         postctx = SiloPostingContext(self.ctx, profile_url_handlers)
         feed = parse_url(self.url, self.name, self.config)
+
+        # Make the cards for all the entries we need to post first, so that
+        # silos get a chance to prepare things for all of them at once.
+        pending_cards = []
         for entry in feed.entries:
-            self.processEntry(ok_silos, postctx, entry)
+            pending_cards += self.getEntryCards(ok_silos, postctx, entry)
+        for silo in ok_silos:
+            try:
+                silo.prepareEntryCards(
+                    [card for s, card in pending_cards if s is silo], postctx)
+            except Exception as ex:
+                logger.error("Error preparing entries for silo '%s'" % silo.name)
+                logger.error(ex)
+
+        for silo, entry_card in pending_cards:
+            self.postEntryCard(silo, postctx, entry_card)
 
         self.postProcess(ok_silos)
 
@@ -70,15 +84,17 @@ class Processor:
         for silo in silos:
             silo.onPostEnd(self.ctx)
 
-    def processEntry(self, silos, postctx, entry):
+    def getEntryCards(self, silos, postctx, entry):
+        entry_cards = []
+
         entry_url = entry.get('url')
         if not entry_url:
             logger.warning("Found entry without a URL: %s" % repr(entry._mf_entry))
-            return
+            return entry_cards
 
         if self.isEntryFiltered(entry):
             logger.debug("Entry is filtered out: %s" % entry_url)
-            return
+            return entry_cards
 
         no_cache = self.ctx.args.no_cache
         only_since = self.ctx.args.since
@@ -116,33 +132,55 @@ class Processor:
                              (silo.name, entry_url))
                 continue
 
-            entry_card = silo.getEntryCard(entry, postctx)
+            # Don't let one bad entry prevent the other ones from being
+            # posted.
+            try:
+                entry_card = silo.getEntryCard(entry, postctx)
+            except Exception as ex:
+                logger.error("Error making content for '%s': %s" %
+                             (silo.name, entry_url))
+                logger.error(ex)
+                continue
             if not entry_card:
                 logger.error("Can't find any content to use for entry: %s" % entry_url)
                 continue
 
-            media_callback = silo.mediaCallback
-            max_size = getattr(silo, 'PHOTO_LIMIT', None)
-            if self.ctx.args.dry_run:
-                media_callback = silo.dryRunMediaCallback
-                max_size = None
-            media_ids = upload_silo_media(entry_card, 'photo', media_callback, max_size)
-
-            if not self.ctx.args.dry_run:
-                logger.debug("Posting to '%s': %s" % (silo.name, entry_url))
-                try:
-                    did_post = silo.postEntry(entry_card, media_ids, postctx)
-                except Exception as ex:
-                    did_post = False
-                    logger.error("Error posting: %s" % entry_url)
-                    logger.error(ex)
-                    if self.ctx.args.verbose:
-                        raise
-                if did_post is True or did_post is None:
-                    self.ctx.cache.addPost(silo.name, entry_url)
-            else:
-                logger.info("Would post to '%s': %s" % (silo.name, entry_url))
-                silo.dryRunPostEntry(entry_card, media_ids, postctx)
+            entry_cards.append((silo, entry_card))
+
+        return entry_cards
+
+    def postEntryCard(self, silo, postctx, entry_card):
+        # Check the cache again in case the same entry showed up more than
+        # once in the feed.
+        entry_url = entry_card.entry.get('url')
+        if (not self.ctx.args.no_cache and
+                self.ctx.cache.wasPosted(silo.name, entry_url)):
+            logger.debug("Skipping already posted entry on %s: %s" %
+                         (silo.name, entry_url))
+            return
+
+        media_callback = silo.mediaCallback
+        max_size = getattr(silo, 'PHOTO_LIMIT', None)
+        if self.ctx.args.dry_run:
+            media_callback = silo.dryRunMediaCallback
+            max_size = None
+        media_ids = upload_silo_media(entry_card, 'photo', media_callback, max_size)
+
+        if not self.ctx.args.dry_run:
+            logger.debug("Posting to '%s': %s" % (silo.name, entry_url))
+            try:
+                did_post = silo.postEntry(entry_card, media_ids, postctx)
+            except Exception as ex:
+                did_post = False
+                logger.error("Error posting: %s" % entry_url)
+                logger.error(ex)
+                if self.ctx.args.verbose:
+                    raise
+            if did_post is True or did_post is None:
+                self.ctx.cache.addPost(silo.name, entry_url)
+        else:
+            logger.info("Would post to '%s': %s" % (silo.name, entry_url))
+            silo.dryRunPostEntry(entry_card, media_ids, postctx)
 
     def isEntryFiltered(self, entry):
         if not self.config.has_section('filter'):
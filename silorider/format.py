@@ -1,14 +1,21 @@
 import re
 import string
 import logging
+import functools
 import urllib.request
 import textwrap
 import bs4
+import bs4.dammit
 from .config import has_lxml
 
+if has_lxml:
+    import lxml.etree
+
 
 logger = logging.getLogger(__name__)
 
+_PARSER = 'lxml' if has_lxml else 'html5lib'
+
 _disable_get_card_info = False
 
 
@@ -16,13 +23,16 @@ def format_entry(entry, *,
                  silo_name=None, silo_type=None,
                  limit=None, card_props=None,
                  add_url='auto', url_flattener=None,
-                 profile_url_handlers=None, url_mode=None):
+                 profile_url_handlers=None, profile_url_handler=None,
+                 url_mode=None):
     url = entry.url
 
     ctx = HtmlStrippingContext()
     ctx.silo_name = silo_name
     ctx.silo_type = silo_type
-    if profile_url_handlers:
+    if profile_url_handler:
+        ctx.profile_url_handler = profile_url_handler
+    elif profile_url_handlers:
         ctx.profile_url_handler = ProfileUrlHandler(profile_url_handlers)
     if url_flattener:
         ctx.url_flattener = url_flattener
@@ -31,6 +41,7 @@ def format_entry(entry, *,
     # Don't add the limit yet.
 
     card = None
+    best_elem = None
 
     # See if we can use a nice blurb for articles instead of their title.
     if card_props and not entry.is_micropost and not _disable_get_card_info:
@@ -38,10 +49,16 @@ def format_entry(entry, *,
 
     # Otherwise, find the best text, generally the title of the article, or the
     # text of the micropost.
+    # We keep the element around in case we need to strip it again with
+    # a limit.
     if card is None:
-        best_text = get_best_text(entry, ctx)
-        if best_text:
-            card = CardInfo(entry, best_text, None, 'best_text')
+        best_elem = _find_best_text_elem(entry)
+        if best_elem:
+            if isinstance(best_elem, str):
+                best_elem = bs4.BeautifulSoup(best_elem, _PARSER)
+            best_text = strip_html(best_elem, ctx)
+            if best_text:
+                card = CardInfo(entry, best_text, None, 'best_text')
 
     if not card:
         raise Exception("Can't find best text for entry: %s" % url)
@@ -55,13 +72,13 @@ def format_entry(entry, *,
         if do_add_url and url:
             # We need to add the URL at the end of the post, so account
             # for it plus a space by making the text length limit smaller.
-            limit -= 1 + ctx.url_flattener.measureUrl(url)
+            limit -= 1 + ctx.measureUrl(url)
 
         shortened = text_length > limit
         if shortened:
             if not do_add_url and add_url == 'auto' and url:
                 do_add_url = True
-                limit -= 1 + ctx.url_flattener.measureUrl(url)
+                limit -= 1 + ctx.measureUrl(url)
 
             if card.is_from == 'best_text':
                 # We need to shorten the text! We can't really reason about it
@@ -75,7 +92,7 @@ def format_entry(entry, *,
                 if url_flattener:
                     ctx.url_flattener = url_flattener
                     url_flattener.reset()
-                card.text = get_best_text(entry, ctx)
+                card.text = strip_html(best_elem, ctx)
             else:
                 # We need to shorten the blurb! We can't do much else besides
                 # truncate it...
@@ -88,7 +105,7 @@ def format_entry(entry, *,
     if do_add_url and url:
         ctx.reportAddedText(1)  # for the space before the URL.
         url = _process_end_url(url, ctx)
-        url_len = ctx.url_flattener.measureUrl(url)
+        url_len = ctx.measureUrl(url)
         ctx.reportAddedText(url_len)
         card.text += ' ' + url
     return card
@@ -113,13 +130,21 @@ class CardInfo:
 class ProfileUrlHandler:
     def __init__(self, handlers=None):
         self.handlers = handlers
+        # The same links tend to show up again and again in a feed, so
+        # remember what the handlers said about them.
+        self._handleUrlCached = functools.lru_cache(maxsize=1024)(
+            self._doHandleUrl)
 
     def handleUrl(self, text, url):
-        if self.handlers:
-            for name, handler in self.handlers.items():
-                res = handler.handleUrl(text, url)
-                if res:
-                    return name, res
+        if not self.handlers:
+            return None, None
+        return self._handleUrlCached(text, url)
+
+    def _doHandleUrl(self, text, url):
+        for name, handler in self.handlers.items():
+            res = handler.handleUrl(text, url)
+            if res:
+                return name, res
         return None, None
 
 
@@ -147,6 +172,12 @@ URLMODE_LAST = 1
 URLMODE_BOTTOM_LIST = 2
 URLMODE_ERASE = 3
 
+
+def utf8_len(txt):
+    # ASCII strings have as many bytes as characters, no need to encode them.
+    return len(txt) if txt.isascii() else len(txt.encode('utf8'))
+
+
 class HtmlStrippingContext:
     def __init__(self):
         # The name and type of the silo we are working for
@@ -172,6 +203,8 @@ class HtmlStrippingContext:
         self._byte_length = 0
         # Whether limit was reached
         self._limit_reached = False
+        # Cache of measured URL lengths
+        self._url_len_cache = {}
 
     @property
     def text_length(self):
@@ -190,7 +223,7 @@ class HtmlStrippingContext:
         next_text_length = self._text_length + added_len
         if (not check_limit) or (self.limit <= 0 or next_text_length <= self.limit):
             self._text_length = next_text_length
-            self._byte_length += len(txt.encode())
+            self._byte_length += utf8_len(txt)
             return txt
 
         if allow_shorten:
@@ -202,13 +235,20 @@ class HtmlStrippingContext:
                 replace_whitespace=False,
                 placeholder="...")
             self._text_length += len(short_txt)
-            self._byte_length += len(short_txt.encode())
+            self._byte_length += utf8_len(short_txt)
             self._limit_reached = True
             return short_txt
         else:
             self._limit_reached = True
             return ''
 
+    def measureUrl(self, url):
+        url_len = self._url_len_cache.get(url)
+        if url_len is None:
+            url_len = self.url_flattener.measureUrl(url)
+            self._url_len_cache[url] = url_len
+        return url_len
+
     def reportSetText(self, charlen, bytelen=None):
         self._text_length = charlen
         self._byte_length = bytelen if bytelen is not None else charlen
@@ -219,12 +259,7 @@ class HtmlStrippingContext:
 
 
 def get_best_text(entry, ctx=None, *, plain=True):
-    elem = entry.htmlFind(class_='p-title')
-    if not elem:
-        elem = entry.htmlFind(class_='p-name')
-    if not elem:
-        elem = entry.htmlFind(class_='e-content')
-
+    elem = _find_best_text_elem(entry)
     if elem:
         if not plain:
             text = '\n'.join([str(c) for c in elem.contents])
@@ -234,55 +269,124 @@ def get_best_text(entry, ctx=None, *, plain=True):
     return None
 
 
+_MISSING = object()
+
+
+def _find_best_text_elem(entry):
+    # Entries are formatted once per silo, so remember what we found,
+    # including when we found nothing.
+    elem = getattr(entry, '_best_elem_cache', _MISSING)
+    if elem is not _MISSING:
+        return elem
+
+    elem = entry.htmlFind(class_='p-title')
+    if not elem:
+        elem = entry.htmlFind(class_='p-name')
+    if not elem:
+        elem = entry.htmlFind(class_='e-content')
+    entry._best_elem_cache = elem
+    return elem
+
+
 def get_card_info(entry, card_props, ctx):
-    logger.debug("Downloading entry page to check meta entries: %s" % entry.url)
-    with urllib.request.urlopen(entry.url) as req:
+    desc, img = _fetch_card_raw(
+        entry.url, card_props.meta_attr,
+        card_props.description, card_props.image)
+    if desc:
+        logger.debug("Found card info, description: %s (image: %s)" % (desc, img))
+        ctx.reportSetText(len(desc), utf8_len(desc))
+        return CardInfo(entry, desc, img, 'card')
+    return None
+
+
+@functools.lru_cache(maxsize=256)
+def _fetch_card_raw(url, meta_attr, description_key, image_key):
+    # Cached on the URL and meta keys only, so that posting the same entry
+    # to several silos only downloads and parses the page once.
+    logger.debug("Downloading entry page to check meta entries: %s" % url)
+    with urllib.request.urlopen(url) as req:
         raw_html = req.read()
+        charset = req.headers.get_content_charset()
+
+    if has_lxml:
+        return _get_card_info_lxml(
+            raw_html, charset, meta_attr, description_key, image_key)
+    return _get_card_info_bs4(
+        raw_html, charset, meta_attr, description_key, image_key)
+
+
+def _get_card_info_lxml(raw_html, charset, meta_attr, description_key, image_key):
+    # Only probe the <head> meta tags with XPath, instead of building a
+    # whole BeautifulSoup tree for the page.
+    # libxml2 assumes Latin-1 when the document doesn't declare its
+    # encoding, so figure it out like BeautifulSoup would (starting with
+    # the HTTP header's charset) and hand it UTF-8.
+    dammit = bs4.dammit.UnicodeDammit(
+        raw_html,
+        known_definite_encodings=[charset] if charset else [],
+        is_html=True)
+    if dammit.unicode_markup is not None:
+        raw_html = dammit.unicode_markup.encode('utf8')
+        parser = lxml.etree.HTMLParser(encoding='utf8')
+    else:
+        parser = None
+    doc = lxml.etree.HTML(raw_html, parser)
+    if doc is None:
+        return None, None
+
+    xpath = '/html/head/meta[@%s=$k]/@content' % meta_attr
+    descs = doc.xpath(xpath, k=description_key)
+    imgs = doc.xpath(xpath, k=image_key)
+    return (str(descs[0]) if descs else None,
+            str(imgs[0]) if imgs else None)
 
-    bs_html = bs4.BeautifulSoup(raw_html,
-            'lxml' if has_lxml else 'html5lib')
+
+def _get_card_info_bs4(raw_html, charset, meta_attr, description_key, image_key):
+    bs_html = bs4.BeautifulSoup(raw_html, _PARSER, from_encoding=charset)
     head = bs_html.find('head')
 
-    desc_meta = head.find('meta', attrs={card_props.meta_attr: card_props.description})
+    desc_meta = head.find('meta', attrs={meta_attr: description_key})
     desc = desc_meta.attrs.get('content') if desc_meta else None
 
-    img_meta = head.find('meta', attrs={card_props.meta_attr: card_props.image})
+    img_meta = head.find('meta', attrs={meta_attr: image_key})
     img = img_meta.attrs.get('content') if img_meta else None
 
-    if desc:
-        logger.debug("Found card info, description: %s (image: %s)" % (desc, img))
-        ctx.reportSetText(len(desc), len(desc.encode('utf8')))
-        return CardInfo(entry, desc, img, 'card')
-    return None
+    return desc, img
 
 
 def strip_html(bs_elem, ctx=None):
     if isinstance(bs_elem, str):
-        bs_elem = bs4.BeautifulSoup(bs_elem,
-                                    'lxml' if has_lxml else 'html5lib')
+        bs_elem = bs4.BeautifulSoup(bs_elem, _PARSER)
 
     # Prepare stuff and run stripping on all HTML elements.
-    outtxt = ''
     if ctx is None:
         ctx = HtmlStrippingContext()
-    for c in bs_elem.children:
-        outtxt += _do_strip_html(c, ctx)
+
+    # If there are no hyperlinks, lists, or paragraphs in there, we just
+    # have some flat text (maybe with some inline formatting) so we don't
+    # need to recurse through the whole tree and insert URLs.
+    if bs_elem.find(_tags_with_handlers) is None:
+        return ctx.processText(''.join([
+            str(d) for d in bs_elem.descendants
+            if isinstance(d, bs4.NavigableString) and _include_text(d)]))
+
+    outtxt = ''.join(_do_strip_html(c, ctx) for c in bs_elem.children)
 
     # If URLs are inline, insert them where we left our marker. If not, replace
     # our markers with an empty string and append the URLs at the end.
     # If we reached the limit with the text alone, replace URLs with empty
     # strings and bail out.
-    keys = ['url:%d' % i for i in range(len(ctx.urls))]
     if not ctx.limit_reached and ctx.url_mode == URLMODE_INLINE:
         url_repl = [' ' + u for u in ctx.urls]
         # Some URLs didn't have any text to be placed next to, so for those
         # we don't need any extra space before.
         for i in ctx.nosp_urls:
             url_repl[i] = url_repl[i][1:]
-        urls = dict(zip(keys, url_repl))
     else:
-        urls = dict(zip(keys, [''] * len(ctx.urls)))
-    outtxt = outtxt % urls
+        url_repl = [''] * len(ctx.urls)
+    if url_repl:
+        outtxt = _url_marker_re.sub(
+            lambda m: url_repl[int(m.group(1))], outtxt)
     if ctx.limit_reached:
         return outtxt
     if ctx.urls:
@@ -310,7 +414,7 @@ def strip_html(bs_elem, ctx=None):
     if ctx.url_mode != URLMODE_ERASE:
         # Add the length of URLs to the text length.
         for url in ctx.urls:
-            url_len = ctx.url_flattener.measureUrl(url)
+            url_len = ctx.measureUrl(url)
             ctx.reportAddedText(url_len)
         # Add spaces and other extra characters to the text length.
         if ctx.url_mode == URLMODE_INLINE:
@@ -329,14 +433,19 @@ def _process_end_url(url, ctx):
     return new_url if new_url is not None else url
 
 
-def _escape_percents(txt):
-    return txt.replace('%', '%%')
+# Markers left in the text where URLs should later be inserted. We use
+# control characters that can't appear in the text we strip.
+_url_marker_re = re.compile('\x00(\\d+)\x01')
+
 
+def _url_marker(idx):
+    return '\x00%d\x01' % idx
 
-tags_valid_for_whitespace = {
+
+tags_valid_for_whitespace = frozenset({
     'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
     'p'
-}
+})
 
 
 def _do_strip_html(elem, ctx):
@@ -347,114 +456,164 @@ def _do_strip_html(elem, ctx):
         # it if it's inside a valid text tag like <p>. Otherwise, it's
         # most likely whitespace inside html markup, such as indenting and
         # newlines between html tags.
-        include_this = True
-        raw_txt = str(elem)
-        if raw_txt.isspace():
-            include_this = False
-            for p in elem.parents:
-                if p and p.name in tags_valid_for_whitespace:
-                    include_this = True
-                    break
-
-        if include_this:
-            return _escape_percents(ctx.processText(raw_txt))
+        if _include_text(elem):
+            return ctx.processText(str(elem))
         else:
             return ''
 
-    if elem.name == 'a':
-        try:
-            href = elem['href']
-        except KeyError:
-            href = None
+    handler = _tag_handlers.get(elem.name)
+    if handler is not None:
+        return handler(elem, ctx)
+
+    return ''.join([_do_strip_html(c, ctx) for c in elem.children])
+
+
+def _include_text(elem):
+    if not elem.isspace():
+        return True
+    for p in elem.parents:
+        if p and p.name in tags_valid_for_whitespace:
+            return True
+    return False
 
-        # Get the text under the hyperlink.
-        cnts = list(elem.contents)
-        if len(cnts) == 1:
-            a_txt = _escape_percents(cnts[0].string)
-        else:
-            a_txt = ''.join([_do_strip_html(c, ctx)
-                             for c in cnts])
-
-        # See if the URL is a link to a social media profile. If so,
-        # we will want to strip it out for any silo that isn't for
-        # that social network platform.
-        name, new_txt = ctx.profile_url_handler.handleUrl(a_txt, href)
-        if name:
-            if ctx.silo_type == name:
-                # Correct silo, return the processed text.
-                return ctx.processText(new_txt, False)
-            else:
-                # Another silo, strip the link.
-                return a_txt
-
-        # Use the URL flattener to reformat the hyperlink.
-        href_flattened = ctx.url_flattener.replaceHref(a_txt, href, ctx)
-        if href_flattened is not None:
-            # We have a reformatted URL, use that.
-            return ctx.processText(href_flattened, False)
-
-        # If we have a simple hyperlink where the text is a substring of
-        # the target URL, just return the URL.
-        if a_txt in href:
-            if ctx.url_mode != URLMODE_ERASE:
-                a_txt = '%%(url:%d)s' % len(ctx.urls)
-                ctx.nosp_urls.append(len(ctx.urls))
-                ctx.urls.append(href)
-                # No text length to add.
-                return a_txt
-            else:
-                return a_txt
 
-        # No easy way to simplify this hyperlink... let's put a marker
-        # for the URL to be later replaced in the text.
-        # Text length is accumulated through recursive calls to _do_strip_html.
+def _do_strip_html_a(elem, ctx):
+    try:
+        href = elem['href']
+    except KeyError:
+        href = None
+
+    # Get the text under the hyperlink.
+    cnts = list(elem.contents)
+    if len(cnts) == 1:
+        a_txt = cnts[0].string
+    else:
         a_txt = ''.join([_do_strip_html(c, ctx)
                          for c in cnts])
-        a_txt += '%%(url:%d)s' % len(ctx.urls)
-        ctx.urls.append(href)
-        return a_txt
-
-    if elem.name == 'ol':
-        outtxt = ''
-        for i, c in enumerate(elem.children):
-            if c.name == 'li':
-                ol_prefix = ('%s. ' % (i + 1))
-                outtxt += ol_prefix + _do_strip_html(c, ctx) + '\n'
-                ctx.reportAddedText(ol_prefix + 1)
-        return outtxt
 
-    if elem.name == 'ul':
-        outtxt = ''
-        for c in elem.children:
-            if c.name == 'li':
-                outtxt += '- ' + _do_strip_html(c, ctx) + '\n'
-                ctx.reportAddedText(3)
-        return outtxt
+    # See if the URL is a link to a social media profile. If so,
+    # we will want to strip it out for any silo that isn't for
+    # that social network platform.
+    name, new_txt = ctx.profile_url_handler.handleUrl(a_txt, href)
+    if name:
+        if ctx.silo_type == name:
+            # Correct silo, return the processed text.
+            return ctx.processText(new_txt, False)
+        else:
+            # Another silo, strip the link.
+            return a_txt
+
+    # Use the URL flattener to reformat the hyperlink.
+    href_flattened = ctx.url_flattener.replaceHref(a_txt, href, ctx)
+    if href_flattened is not None:
+        # We have a reformatted URL, use that.
+        return ctx.processText(href_flattened, False)
+
+    # If we have a simple hyperlink where the text is a substring of
+    # the target URL, just return the URL.
+    if a_txt in href:
+        if ctx.url_mode != URLMODE_ERASE:
+            a_txt = _url_marker(len(ctx.urls))
+            ctx.nosp_urls.append(len(ctx.urls))
+            ctx.urls.append(href)
+            # No text length to add.
+            return a_txt
+        else:
+            return a_txt
+
+    # No easy way to simplify this hyperlink... let's put a marker
+    # for the URL to be later replaced in the text.
+    # Text length is accumulated through recursive calls to _do_strip_html.
+    a_txt = ''.join([_do_strip_html(c, ctx)
+                     for c in cnts])
+    a_txt += _url_marker(len(ctx.urls))
+    ctx.urls.append(href)
+    return a_txt
+
+
+def _do_strip_html_ol(elem, ctx):
+    parts = []
+    for i, c in enumerate(elem.children):
+        if c.name == 'li':
+            ol_prefix = ('%s. ' % (i + 1))
+            parts.append(ol_prefix)
+            parts.append(_do_strip_html(c, ctx))
+            parts.append('\n')
+            ctx.reportAddedText(len(ol_prefix) + 1)
+    return ''.join(parts)
+
+
+def _do_strip_html_ul(elem, ctx):
+    parts = []
+    for c in elem.children:
+        if c.name == 'li':
+            parts.append('- ')
+            parts.append(_do_strip_html(c, ctx))
+            parts.append('\n')
+            ctx.reportAddedText(3)
+    return ''.join(parts)
+
+
+def _do_strip_html_p(elem, ctx):
+    # Add a newline before starting a paragraph only if this isn't
+    # the first paragraph or piece of content.
+    parts = []
+    if ctx.text_length > 0:
+        parts.append('\n')
+        ctx.reportAddedText(1)
+    for c in elem.children:
+        parts.append(_do_strip_html(c, ctx))
+    return ''.join(parts)
+
+
+_tag_handlers = {
+    'a': _do_strip_html_a,
+    'ol': _do_strip_html_ol,
+    'ul': _do_strip_html_ul,
+    'p': _do_strip_html_p
+}
 
-    if elem.name == 'p':
-        # Add a newline before starting a paragraph only if this isn't
-        # the first paragraph or piece of content.
-        p_txt = ''
-        if ctx.text_length > 0:
-            p_txt = '\n'
-            ctx.reportAddedText(1)
-        for c in elem.children:
-            p_txt += _do_strip_html(c, ctx)
-        return p_txt
+_tags_with_handlers = list(_tag_handlers)
 
-    return ''.join([_do_strip_html(c, ctx) for c in elem.children])
+
+# A sentence ends with a period, question mark, or exclamation mark followed
+# by some whitespace. Periods must come after a word character or some
+# closing punctuation.
+_sentence_terminators = tuple(
+    p + ws for p in '.?!' for ws in string.whitespace)
+_chars_valid_before_period = frozenset('])"\'.')
+
+
+def _find_sentence_end(txt, end):
+    # Returns the index of the earliest sentence-ending punctuation whose
+    # following whitespace is before `end`, or -1.
+    best = -1
+    for t in _sentence_terminators:
+        i = txt.find(t, 0, end)
+        if t[0] == '.':
+            while i >= 0 and not _is_valid_before_period(txt, i):
+                i = txt.find(t, i + 1, end)
+        if i >= 0:
+            best = i
+            # Only look for earlier matches from now on.
+            end = i + 1
+    return best
 
 
-re_sentence_end = re.compile(r'[\w\]\)\"\'\.]\.\s|[\?\!]\s')
+def _is_valid_before_period(txt, i):
+    if i == 0:
+        return False
+    c = txt[i - 1]
+    return c.isalnum() or c == '_' or c in _chars_valid_before_period
 
 
 def shorten_text(txt, limit):
     if len(txt) <= limit:
         return (txt, False)
 
-    m = re_sentence_end.search(txt)
-    if m and m.end <= (limit + 1):
-        return (txt[:m.end - 1], True)
+    i = _find_sentence_end(txt, limit + 1)
+    if i >= 0:
+        return (txt[:i + 1], True)
 
     shorter = textwrap.shorten(
         txt, width=limit, placeholder="...")
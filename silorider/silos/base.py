@@ -1,22 +1,36 @@
 import os
 import os.path
+import sys
 import uuid
+import shutil
+import importlib
 import urllib.request
 import logging
+import functools
 import tempfile
 import mimetypes
+import concurrent.futures
 from PIL import Image
-from ..format import format_entry
+from ..format import format_entry, ProfileUrlHandler
 
 
 logger = logging.getLogger(__name__)
 
+# Buffer size used when downloading media files to disk.
+_DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+# How many media files can be downloaded at the same time for a post.
+_MAX_DOWNLOAD_WORKERS = 4
+
+# Load the MIME types database up front, we'll need it for any media upload.
+mimetypes.init()
+
 
 class SiloCreationContext:
-    def __init__(self, config, cache, silo_name):
+    def __init__(self, config, cache, silo_name, sec_items=None):
         self.config = config
         self.cache = cache
         self.silo_name = silo_name
+        self.sec_items = sec_items
 
 
 class SiloContextBase:
@@ -48,6 +62,8 @@ class SiloPostingContext(SiloContextBase):
     def __init__(self, exec_ctx, profile_url_handlers=None):
         SiloContextBase.__init__(self, exec_ctx)
         self.profile_url_handlers = profile_url_handlers
+        # Shared by all silos for the whole posting run.
+        self.profile_url_handler = ProfileUrlHandler(profile_url_handlers)
 
 
 class SiloProfileUrlHandler:
@@ -60,7 +76,11 @@ class Silo:
 
     def __init__(self, ctx):
         self.ctx = ctx
-        self._silo_cfg = dict(ctx.config.items('silo:%s' % self.name))
+        if ctx.sec_items is not None:
+            self._silo_cfg = ctx.sec_items
+        else:
+            self._silo_cfg = dict(ctx.config.items('silo:%s' % self.name))
+        self._cache_key_prefix = self.name + '_'
 
     @property
     def name(self):
@@ -73,11 +93,11 @@ class Silo:
         return self._silo_cfg.copy()
 
     def getCacheItem(self, name, valtype=str):
-        full_name = '%s_%s' % (self.name, name)
+        full_name = self._cache_key_prefix + name
         return self.ctx.cache.getCustomValue(full_name, valtype=valtype)
 
     def setCacheItem(self, name, val):
-        full_name = '%s_%s' % (self.name, name)
+        full_name = self._cache_key_prefix + name
         return self.ctx.cache.setCustomValue(full_name, val)
 
     def formatEntry(self, entry, *args, **kwargs):
@@ -98,6 +118,9 @@ class Silo:
     def getEntryCard(self, entry, ctx):
         raise NotImplementedError()
 
+    def prepareEntryCards(self, entry_cards, ctx):
+        pass
+
     def mediaCallback(self, tmpfile, mimetype, url, desc):
         raise NotImplementedError()
 
@@ -125,21 +148,29 @@ def has_any_silo(config):
     return bool(_get_silo_section_names(config))
 
 
+# Silo classes by type, given as the module and class name to import. Some
+# silos pull in big SDKs so we only import the ones we need.
+_silo_classes = {
+    'print': ('.print', 'PrintSilo'),
+    'bluesky': ('.bluesky', 'BlueskySilo'),
+    'facebook': ('.facebook', 'FacebookSilo'),
+    'mastodon': ('.mastodon', 'MastodonSilo'),
+    'twitter': ('.twitter', 'TwitterSilo'),
+    'webmention': ('.webmention', 'WebmentionSilo')
+}
+
+
+def _load_silo_class(silo_type):
+    try:
+        mod_name, cls_name = _silo_classes[silo_type]
+    except KeyError:
+        return None
+    mod = importlib.import_module(mod_name, __package__)
+    return getattr(mod, cls_name)
+
+
 def load_silos(config, cache):
-    from .print import PrintSilo
-    from .bluesky import BlueskySilo
-    from .facebook import FacebookSilo
-    from .mastodon import MastodonSilo
-    from .twitter import TwitterSilo
-    from .webmention import WebmentionSilo
-    silo_types = [
-        PrintSilo,
-        BlueskySilo,
-        FacebookSilo,
-        MastodonSilo,
-        TwitterSilo,
-        WebmentionSilo]
-    silo_dict = dict([(s.SILO_TYPE, s) for s in silo_types])
+    silo_dict = {}
 
     silos = []
     sec_names = _get_silo_section_names(config)
@@ -152,10 +183,14 @@ def load_silos(config, cache):
 
         silo_class = silo_dict.get(silo_type)
         if not silo_class:
-            raise Exception("Unknown silo type: %s" % silo_type)
+            silo_class = _load_silo_class(silo_type)
+            if not silo_class:
+                raise Exception("Unknown silo type: %s" % silo_type)
+            silo_dict[sys.intern(silo_type)] = silo_class
 
         logger.debug("Creating silo '%s' for '%s'." % (silo_type, silo_name))
-        cctx = SiloCreationContext(config, cache, silo_name)
+        cctx = SiloCreationContext(config, cache, silo_name,
+                                   sec_items=sec_items)
         silo = silo_class(cctx)
         silos.append(silo)
     return silos
@@ -176,10 +211,18 @@ def upload_silo_media(card, propname, callback, max_size=None):
         media_ids = None
         media_entries = card.entry.get(propname, [], force_list=True)
         if media_entries:
+            # Download all the media files at once, but upload them in order
+            # since we don't know if silo clients are thread-safe.
+            media_infos = [_img_url_and_alt(me) for me in media_entries]
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=_MAX_DOWNLOAD_WORKERS) as executor:
+                downloads = list(executor.map(
+                    lambda info: _download_silo_media(tmpdir, info[0], max_size),
+                    media_infos))
+
             media_ids = []
-            for media_entry in media_entries:
-                url, desc = _img_url_and_alt(media_entry)
-                mid = _do_upload_silo_media(tmpdir, url, desc, callback, max_size)
+            for (url, desc), (tmpfile, mt) in zip(media_infos, downloads):
+                mid = callback(tmpfile, mt, url, desc)
                 if mid is not None:
                     media_ids.append(mid)
 
@@ -187,24 +230,42 @@ def upload_silo_media(card, propname, callback, max_size=None):
 
 
 def _do_upload_silo_media(tmpdir, url, desc, callback, max_size=None):
+    tmpfile, mt = _download_silo_media(tmpdir, url, max_size)
+    return callback(tmpfile, mt, url, desc)
+
+
+def _download_silo_media(tmpdir, url, max_size=None):
     logger.debug("Downloading %s for upload to silo..." % url)
-    mt, enc = mimetypes.guess_type(url, strict=False)
+    mt, enc = _guess_mime_type(url)
     if not mt:
         logger.debug("Can't guess MIME type, defaulting to jpg")
         mt = mimetypes.common_types['.jpg']
 
-    ext = mimetypes.guess_extension(mt) or '.jpg'
+    ext = _guess_extension(mt) or '.jpg'
     logger.debug("Got MIME type and extension: %s %s" % (mt, ext))
 
-    try:
-        tmpfile = os.path.join(tmpdir, str(uuid.uuid4()) + ext)
-        logger.debug("Downloading photo to temporary file: %s" % tmpfile)
-        tmpfile, headers = urllib.request.urlretrieve(url, filename=tmpfile)
-        tmpfile = _ensure_file_not_too_large(tmpfile, max_size)
-        return callback(tmpfile, mt, url, desc)
-    finally:
-        logger.debug("Cleaning up.")
-        urllib.request.urlcleanup()
+    tmpfile = os.path.join(tmpdir, str(uuid.uuid4()) + ext)
+    logger.debug("Downloading photo to temporary file: %s" % tmpfile)
+    tmpfile = _download_media(url, tmpfile)
+    tmpfile = _ensure_file_not_too_large(tmpfile, max_size)
+    return tmpfile, mt
+
+
+@functools.lru_cache(maxsize=256)
+def _guess_mime_type(url):
+    return mimetypes.guess_type(url, strict=False)
+
+
+@functools.lru_cache(maxsize=64)
+def _guess_extension(mt):
+    return mimetypes.guess_extension(mt)
+
+
+def _download_media(url, path):
+    # The temporary file is cleaned up along with its temporary directory.
+    with urllib.request.urlopen(url) as resp, open(path, 'wb') as fp:
+        shutil.copyfileobj(resp, fp, _DOWNLOAD_BUFFER_SIZE)
+    return path
 
 
 def _ensure_file_not_too_large(path, max_size):
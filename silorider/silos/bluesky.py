@@ -1,23 +1,29 @@
 import re
 import bs4
+import bs4.dammit
+import codecs
 import os.path
-import gzip
 import json
-import time
 import random
-import signal
+import hashlib
 import urllib.error
 import urllib.parse
-import urllib.request
+import urllib3
 import getpass
+import email.message
 import logging
 import datetime
+import concurrent.futures
 from .base import Silo
 from ..config import has_lxml
-from ..format import CardProps, UrlFlattener, URLMODE_ERASE
+from ..format import CardProps, UrlFlattener, URLMODE_ERASE, utf8_len
+
+if has_lxml:
+    import lxml.etree
 
 import atproto
 from atproto import models as atprotomodels
+from atproto import exceptions as atprotoexceptions
 
 
 logger = logging.getLogger(__name__)
@@ -25,6 +31,10 @@ logger = logging.getLogger(__name__)
 re_hashtags = re.compile(r'#[\w\d]+')
 
 
+# Time zone for post dates that don't have one.
+_LOCAL_TZ = datetime.datetime.now().astimezone().tzinfo
+
+
 class _BlueskyClient(atproto.Client):
     def __init__(self, *args, **kwargs):
         atproto.Client.__init__(self, *args, **kwargs)
@@ -37,10 +47,9 @@ class _BlueskyClient(atproto.Client):
         langs = [atprotomodels.languages.DEFAULT_LANGUAGE_CODE1]
 
         # Make sure we have a proper time zone.
-        post_datetime = post_datetime or datetime.datetime.now()
+        post_datetime = post_datetime or datetime.datetime.now(_LOCAL_TZ)
         if not post_datetime.tzinfo:
-            tz_dt = datetime.datetime.now().astimezone()
-            post_datetime = post_datetime.replace(tzinfo=tz_dt.tzinfo)
+            post_datetime = post_datetime.replace(tzinfo=_LOCAL_TZ)
         created_at = post_datetime.isoformat()
 
         # Do it!
@@ -69,6 +78,19 @@ class BlueskySilo(Silo):
         base_url = self.getConfigItem('url')
         self.client = self._CLIENT_CLASS(base_url)
 
+        # Use the same user-agent for all the requests we make in this run.
+        self._http_headers = {
+                **_DEFAULT_REQ_HEADERS,
+                'User-Agent': random.choice(_user_agents)}
+
+        # Link embed infos being fetched in the background, by URL.
+        self._embed_executor = None
+        self._embed_prefetches = {}
+        # Link embeds we already made, by URL, and uploaded thumbnail
+        # blobs, by SHA-256 of their data.
+        self._embed_cache = {}
+        self._thumb_blob_cache = {}
+
     def authenticate(self, ctx):
         force = ctx.exec_ctx.args.force
 
@@ -84,15 +106,36 @@ class BlueskySilo(Silo):
 
             logger.info("Authenticated as %s" % profile.display_name)
             self.setCacheItem('password', password)
+            self._saveSession()
 
     def onPostStart(self, ctx):
         if not ctx.args.dry_run:
-            email = self.getCacheItem('email')
-            password = self.getCacheItem('password')
-            if not email or not password:
-                raise Exception("Please authenticate Bluesky silo %s" %
-                                self.ctx.silo_name)
-            self.client.login(email, password)
+            self._login()
+
+    def _login(self):
+        # Reuse the session from the last run if we can, since creating
+        # a new session is heavily rate-limited. The client refreshes the
+        # session tokens if needed.
+        session = self.getCacheItem('session')
+        if session:
+            try:
+                self.client.login(session_string=session)
+                return
+            except (atprotoexceptions.BadRequestError,
+                    atprotoexceptions.UnauthorizedError) as ex:
+                logger.debug("Can't reuse Bluesky session, logging in again.")
+                logger.debug(str(ex))
+
+        email = self.getCacheItem('email')
+        password = self.getCacheItem('password')
+        if not email or not password:
+            raise Exception("Please authenticate Bluesky silo %s" %
+                            self.ctx.silo_name)
+        self.client.login(email, password)
+        self._saveSession()
+
+    def _saveSession(self):
+        self.setCacheItem('session', self.client.export_session_string())
 
     def getEntryCard(self, entry, ctx):
         # We use URLMODE_ERASE to remove all hyperlinks from the
@@ -104,15 +147,67 @@ class BlueskySilo(Silo):
             limit=300,
             # Use Twitter's meta properties
             card_props=CardProps('name', 'twitter'),
-            profile_url_handlers=ctx.profile_url_handlers,
+            profile_url_handler=ctx.profile_url_handler,
             url_flattener=url_flattener,
             url_mode=URLMODE_ERASE)
-        card.__bsky_url_flattener = url_flattener
+        card._bsky_url_flattener = url_flattener
         return card
 
+    def prepareEntryCards(self, entry_cards, ctx):
+        if ctx.dry_run:
+            return
+
+        # Start fetching what we need for the link embeds of all the posts
+        # we're about to make, instead of waiting on each of them in turn.
+        for card in entry_cards:
+            # Posts with photos get an image embed instead.
+            if card.image or card.entry.get('photo'):
+                continue
+
+            url_flattener = card._bsky_url_flattener
+            if not url_flattener.urls:
+                continue
+
+            url = url_flattener.urls[0][2]
+            if url in self._embed_prefetches:
+                continue
+
+            if self._embed_executor is None:
+                self._embed_executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=_EMBED_FETCH_WORKERS)
+            self._embed_prefetches[url] = self._embed_executor.submit(
+                    _fetch_url_embed_info, _http, url, self._http_headers)
+
+    def onPostEnd(self, ctx):
+        # Save the session again in case its tokens were refreshed.
+        if not ctx.args.dry_run:
+            self._saveSession()
+
+        if self._embed_executor is not None:
+            self._embed_executor.shutdown(wait=False, cancel_futures=True)
+            self._embed_executor = None
+        self._embed_prefetches = {}
+
     def mediaCallback(self, tmpfile, mt, url, desc):
-        with open(tmpfile, 'rb') as tmpfp:
-            data = tmpfp.read()
+        # Check the size before loading the whole file in memory. The
+        # media should have been resized already, so this is a last resort.
+        file_size = os.path.getsize(tmpfile)
+        if file_size > self.PHOTO_LIMIT:
+            logger.warning("Image is too large for Bluesky (%d bytes), skipping: %s" %
+                           (file_size, url))
+            return None
+
+        # Read the file unbuffered, straight into a bytes object of the right
+        # size. This has to be bytes (not a memoryview or mmap) because the
+        # HTTP client iterates over anything else.
+        with open(tmpfile, 'rb', buffering=0) as tmpfp:
+            data = tmpfp.read(file_size)
+
+        # Don't waste an upload (which are limited per day) on something
+        # Bluesky won't take as an image.
+        if not _is_image_magic(data):
+            logger.warning("Not a recognized image format, skipping: %s" % url)
+            return None
 
         logger.debug("Uploading image to Bluesky (%d bytes) with description: %s" %
                      (len(data), desc))
@@ -130,25 +225,10 @@ class BlueskySilo(Silo):
 
         # Grab any URLs detected by our URL flattener and add them as
         # facets on the atproto record.
-        facets = []
-        first_url = None
-        url_flattener = entry_card.__bsky_url_flattener
-        if url_flattener.urls:
-            for url_info in url_flattener.urls:
-                # atproto requires an http or https scheme.
-                start, end, url = url_info
-                if not url.startswith('http'):
-                    url = 'https://' + url
-
-                facet = atprotomodels.AppBskyRichtextFacet.Main(
-                    features=[atprotomodels.AppBskyRichtextFacet.Link(uri=url)],
-                    index=atprotomodels.AppBskyRichtextFacet.ByteSlice(
-                        byteStart=start, byteEnd=end)
-                    )
-                facets.append(facet)
-
-                if first_url is None:
-                    first_url = url
+        url_flattener = entry_card._bsky_url_flattener
+        facets = [_make_link_facet(start, end, url)
+                  for start, end, url in url_flattener.urls]
+        first_url = url_flattener.urls[0][2] if url_flattener.urls else None
 
         # Look for hashtags and turn them into facets too.
         entry_text = entry_card.text
@@ -162,11 +242,12 @@ class BlueskySilo(Silo):
             byte_start = len(entry_text[:start].encode())
             byte_end = len(entry_text[:end].encode())
 
-            facet = atprotomodels.AppBskyRichtextFacet.Main(
-                features=[atprotomodels.AppBskyRichtextFacet.Tag(tag=tagname)],
-                index=atprotomodels.AppBskyRichtextFacet.ByteSlice(
-                    byteStart=byte_start, byteEnd=byte_end)
-                )
+            facet = atprotomodels.AppBskyRichtextFacet.Main.model_construct(
+                features=[
+                    atprotomodels.AppBskyRichtextFacet.Tag.model_construct(
+                        tag=tagname)],
+                index=atprotomodels.AppBskyRichtextFacet.ByteSlice.model_construct(
+                    byteStart=byte_start, byteEnd=byte_end))
             facets.append(facet)
 
         # A bit cleaner to pass None instead of an empty array if we don't
@@ -187,122 +268,61 @@ class BlueskySilo(Silo):
                 facets=facets)
 
     def _makeUrlEmbed(self, url):
-        # Fetch the document at the URL.
-        urlopen = urllib.request.urlopen
-        # Because we may hit well-known servers like YouTube, we need to:
-        # 1. specify a user-agent that won't get us thrown out
-        # 2. handle the case of an error 429, which tells us to wait
-        req_headers={
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-                'Accept-Language': 'en-us,en;q=0.5',
-                'Accept-Encoding': 'gzip,deflate'
-                }
-        logging.debug("Fetching link to build Bluesky link embed: %s" % url)
-
-        attempts = 0
-        max_attempts = 3
-        html_raw = None
-        html_encoding = None
-        while attempts < max_attempts:
-            attempts += 1
-            try:
-                req = _build_http_request(url, req_headers)
-                # Wrap the request inside a signal-based timeout just in
-                # case we encounter some problem in low-level code.
-                with SignalTimeout(6, "urlopen timed out!") as sto:
-                    with urlopen(req, timeout=5) as resp:
-                        logging.debug("Response status: %s" % str(resp.status))
-                        logging.debug("Response headers: %s" % str(resp.headers))
-                        html_encoding = resp.headers['Content-Encoding']
-                        html_raw = resp.read()
-                        break
-            except Exception as ex:
-                logger.warning("Couldn't fetch link: %s" % url)
-                logger.warning(str(ex))
-                # See if we are being told to retry after a while. If so,
-                # wait and retry. If not, abort.
-                if not hasattr(ex, 'headers'):
-                    break
-                retry_after = ex.headers.get('Retry-After')
-                if not retry_after:
-                    break
-                try:
-                    wait_time = int(float(retry_after)) + 1
-                except ValueError:
-                    wait_time = -1
-                if wait_time < 0:
-                    break
-                logger.warning(
-                        "Received 'Too Many Requests' error from the server, "
-                        "waiting %d seconds" % wait_time)
-                if wait_time > 60:
-                    logger.warning("Don't want to wait too long, aborting.")
-                    break
-                time.sleep(wait_time)
-
-        if html_raw is None:
-            logger.error("Aborting after %d attempts." % attempts)
-            return None
+        # We may have already made an embed for the same link in this run.
+        # This includes failing to make one, we won't have better luck now.
+        try:
+            return self._embed_cache[url]
+        except KeyError:
+            pass
+
+        embed = self._doMakeUrlEmbed(url)
+        self._embed_cache[url] = embed
+        return embed
 
-        # Optionally unzip it.
-        if html_encoding == 'gzip':
-            html_raw = gzip.decompress(html_raw).decode()
-
-        # Use BeautifulSoup to parse the HTML.
-        logging.debug("Parsing '%s' html document (%d bytes)" % (url, len(html_raw)))
-        html_doc = bs4.BeautifulSoup(
-                html_raw,
-                'lxml' if has_lxml else 'html5lib')
-
-        # Look for title, description, and thumbnail image.
-        # We first try OpenGraph info, fallback to Twitter info, and fallback
-        # last on general HTML5 info.
-        embed_title = _find_meta(html_doc, property="og:title")
-        if not embed_title:
-            embed_title = _find_meta(html_doc, name="twitter:title")
-        if not embed_title:
-            embed_title = html_doc.find("title").string
-
-        if not embed_title:
-            logger.error("Couldn't find title! Aborting making an embed.")
+    def _doMakeUrlEmbed(self, url):
+        # Use the link info we started fetching earlier, if any.
+        # Network errors shouldn't fail the post, we just won't have an
+        # embed.
+        future = self._embed_prefetches.pop(url, None)
+        try:
+            if future is not None:
+                embed_info = future.result()
+            else:
+                embed_info = _fetch_url_embed_info(_http, url, self._http_headers)
+        except _http_errors as ex:
+            logger.warning("Couldn't get link info to build Bluesky embed: %s" % url)
+            logger.warning(str(ex))
+            return None
+        if embed_info is None:
             return None
 
-        embed_description = _find_meta(html_doc, property="og:description")
-        if not embed_description:
-            embed_description = _find_meta(html_doc, name="twitter:description")
-        if not embed_description:
-            embed_description = _find_meta(html_doc, name="description")
-        if not embed_description:
-            logger.warning("Couldn't find description, falling back to title.")
-            embed_description = embed_title
-
-        embed_image = _find_meta(html_doc, property="og:image")
-        if not embed_image:
-            embed_image = _find_meta(html_doc, name="twitter:image")
-        if not embed_image:
-            embed_image = _find_meta(html_doc, property="thumbnail")
-
-        logger.debug(
-                "Creating Bluesky embed with title '%s', description '%s', and "
-                "image '%s'" % (embed_title, embed_description, embed_image))
+        embed_title, embed_description, embed_image, thumb_data = embed_info
 
         # Upload the thumbnail image to Bluesky.
+        # Don't upload the same image twice, since Bluesky limits how many
+        # blobs we can upload in a day.
         embed_thumb_blob = None
-        if embed_image:
-            try:
-                thumb_req = _build_http_request(embed_image)
-                with SignalTimeout(6, "urlopen timed out!") as sto:
-                    with urlopen(thumb_req, timeout=5) as thumb_resp:
-                        thumb_data = thumb_rest.read()
-                        logger.debug(
-                                "Uploading embed image '%s' to Bluesky (%d bytes)" %
-                                (embed_image, len(thumb_data)))
-                        embed_thumb_blob = self.client.com.atproto.repo.upload_blob(thumb_data)
-            except Exception as ex:
-                logger.warning(
-                        "Couldn't fetch thumbnail URL '%s' to build Bluesky embed" %
-                        embed_image)
-                logger.warning(str(ex))
+        if thumb_data is not None and not _is_image_magic(thumb_data):
+            logger.warning(
+                    "Thumbnail '%s' isn't a recognized image format, ignoring it" %
+                    embed_image)
+            thumb_data = None
+        if thumb_data is not None:
+            thumb_hash = hashlib.sha256(thumb_data).digest()
+            embed_thumb_blob = self._thumb_blob_cache.get(thumb_hash)
+            if embed_thumb_blob is None:
+                try:
+                    logger.debug(
+                            "Uploading embed image '%s' to Bluesky (%d bytes)" %
+                            (embed_image, len(thumb_data)))
+                    upload = self.client.com.atproto.repo.upload_blob(thumb_data)
+                    embed_thumb_blob = upload.blob
+                    self._thumb_blob_cache[thumb_hash] = embed_thumb_blob
+                except atprotoexceptions.AtProtocolError as ex:
+                    logger.warning(
+                            "Couldn't upload thumbnail '%s' to build Bluesky embed" %
+                            embed_image)
+                    logger.warning(str(ex))
 
         # Make the embed!
         embed = atprotomodels.AppBskyEmbedExternal.Main(
@@ -314,29 +334,182 @@ class BlueskySilo(Silo):
         return embed
 
 
-def _build_http_request(url, headers=None):
-    req = urllib.request.Request(url)
-    req.add_header('User-Agent', _get_random_user_agent())
-    if headers:
-        for k, v in headers.items():
-            req.add_header(k, v)
-    return req
-
-
-class SignalTimeout:
-    def __init__(self, seconds, error_message):
-        self.seconds = seconds
-        self.error_message = error_message
-
-    def __enter__(self):
-        signal.signal(signal.SIGALRM, self._onTimeout)
-        signal.alarm(self.seconds)
-
-    def __exit__(self, type, value, traceback):
-        signal.alarm(0)
+def _make_link_facet(start, end, url):
+    # We build these ourselves so we skip model validation, which is the
+    # expensive part of making them.
+    return atprotomodels.AppBskyRichtextFacet.Main.model_construct(
+        features=[atprotomodels.AppBskyRichtextFacet.Link.model_construct(uri=url)],
+        index=atprotomodels.AppBskyRichtextFacet.ByteSlice.model_construct(
+            byteStart=start, byteEnd=end))
+
+
+def _fetch_url_embed_info(http, url, headers):
+    # Fetches everything needed to make a link embed for the given URL.
+    # This doesn't touch any silo state so it can run on worker threads.
+    # Returns a tuple with the title, description, image URL, and image data,
+    # or None if there's no embed to make.
+
+    # Fetch the document at the URL.
+    # Because we may hit well-known servers like YouTube, the headers
+    # specify a user-agent that won't get us thrown out. Retrying on
+    # errors like 429 (which tells us to wait) is done by the
+    # connection pool.
+    logging.debug("Fetching link to build Bluesky link embed: %s" % url)
+
+    # We only need the <head> of the document, so we parse it as it comes
+    # and stop reading as soon as we're past it.
+    try:
+        resp = http.request(
+                'GET', url, headers=headers, timeout=_http_timeout,
+                preload_content=False)
+    except _http_errors as ex:
+        logger.warning("Couldn't fetch link: %s" % url)
+        logger.warning(str(ex))
+        return None
+
+    try:
+        logging.debug("Response status: %s" % str(resp.status))
+        logging.debug("Response headers: %s" % str(resp.headers))
+        if resp.status >= 400:
+            logger.error("Couldn't fetch link (HTTP %d): %s" % (resp.status, url))
+            return None
 
-    def _onTimeout(self, signum, frame):
-        raise TimeoutError(self.error_message)
+        html_head = _read_html_head(resp)
+    except _http_errors as ex:
+        logger.warning("Couldn't read link: %s" % url)
+        logger.warning(str(ex))
+        return None
+    finally:
+        # Don't download the rest of the document if we stopped early.
+        # This closes the connection, and the pool will open a new one
+        # when needed.
+        if not resp.isclosed():
+            resp.close()
+        resp.release_conn()
+
+    # Look for title, description, and thumbnail image.
+    # We first try OpenGraph info, fallback to Twitter info, and fallback
+    # last on general HTML5 info.
+    metas = html_head.metas
+    embed_title = metas.get('og:title') or metas.get('twitter:title')
+    if not embed_title:
+        embed_title = html_head.title
+
+    if not embed_title:
+        logger.error("Couldn't find title! Aborting making an embed.")
+        return None
+
+    embed_description = (
+            metas.get('og:description') or
+            metas.get('twitter:description') or
+            metas.get('description'))
+    if not embed_description:
+        logger.warning("Couldn't find description, falling back to title.")
+        embed_description = embed_title
+
+    embed_image = (
+            metas.get('og:image') or
+            metas.get('twitter:image') or
+            metas.get('thumbnail'))
+
+    logger.debug(
+            "Creating Bluesky embed with title '%s', description '%s', and "
+            "image '%s'" % (embed_title, embed_description, embed_image))
+
+    # Download the thumbnail image.
+    thumb_data = None
+    if embed_image:
+        try:
+            thumb_resp = http.request(
+                    'GET', embed_image, headers=headers,
+                    timeout=_http_timeout)
+        except _http_errors as ex:
+            logger.warning(
+                    "Couldn't fetch thumbnail URL '%s' to build Bluesky embed" %
+                    embed_image)
+            logger.warning(str(ex))
+        else:
+            if thumb_resp.status < 400:
+                thumb_data = thumb_resp.data
+            else:
+                logger.warning(
+                        "Couldn't fetch thumbnail URL '%s' to build Bluesky "
+                        "embed (HTTP %d)" % (embed_image, thumb_resp.status))
+
+    return (embed_title, embed_description, embed_image, thumb_data)
+
+
+def _read_html_head(resp):
+    # The pool takes care of decompressing the document, including
+    # multi-member gzip streams.
+    html_head = None
+    read_size = 0
+    for chunk in resp.stream(_HTML_CHUNK_SIZE):
+        if html_head is None:
+            html_head = _HtmlHeadParser(
+                    _get_html_encoding(resp.headers.get('Content-Type'), chunk))
+        read_size += len(chunk)
+        if html_head.feed(chunk):
+            break
+
+    if html_head is None:
+        html_head = _HtmlHeadParser()
+    html_head.close()
+    logging.debug("Parsed html document head (%d bytes read)" % read_size)
+    return html_head
+
+
+class _HttpRetry(urllib3.Retry):
+    # Don't wait on servers that want us to come back much later, just
+    # give up on them.
+    MAX_RETRY_AFTER = 60
+
+    def sleep_for_retry(self, response):
+        retry_after = self.get_retry_after(response)
+        if retry_after is not None and retry_after > self.MAX_RETRY_AFTER:
+            raise urllib3.exceptions.MaxRetryError(
+                    None, response.geturl(),
+                    "Server asked to wait %d seconds" % retry_after)
+        return super().sleep_for_retry(response)
+
+
+# Connection pool for fetching link embed documents and thumbnails, so we
+# can reuse connections to the same hosts. Timeouts are enforced on the
+# sockets themselves.
+# Connection errors and transient server errors are retried with a
+# jittered exponential back-off (or for as long as the server tells us to
+# wait). If the server still errors out, we get its last response back
+# and deal with the status code ourselves.
+# Redirects get their own budget (as many as urllib.request follows),
+# since an overall total would count them against the error retries.
+_http = urllib3.PoolManager(
+        num_pools=16, maxsize=8,
+        retries=_HttpRetry(
+            total=None, connect=3, read=3, status=3, other=3, redirect=10,
+            backoff_factor=0.5, backoff_jitter=0.25,
+            status_forcelist=(429, 500, 502, 503, 504),
+            respect_retry_after_header=True,
+            raise_on_status=False))
+
+_http_timeout = urllib3.Timeout(connect=3, read=5)
+
+# Errors we can expect when fetching things over the network.
+_http_errors = (urllib3.exceptions.HTTPError, OSError)
+
+# How many link embeds can be fetched at the same time.
+_EMBED_FETCH_WORKERS = 8
+
+# Only ask for compression schemes urllib3 can decode here (brotli is only
+# included if the brotli package is installed).
+_accept_encoding = urllib3.util.make_headers(
+        accept_encoding=True)['accept-encoding']
+
+# Headers for all our requests, on top of the user-agent.
+_DEFAULT_REQ_HEADERS = {
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'Accept-Language': 'en-us,en;q=0.5',
+        'Accept-Encoding': _accept_encoding
+        }
 
 
 _user_agents = [
@@ -349,21 +522,153 @@ _user_agents = [
         'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36',
         ]
 
-def _get_random_user_agent():
-    return random.choice(_user_agents)
-
 
-def _find_meta(html_doc, **kwargs):
-    # Pass kwargs as a dictionary so we can also look for tags with a property
-    # named 'name' without conflicting with the find() method's 'name' arg.
-    meta_tag = html_doc.find("meta", dict(kwargs))
-    return meta_tag["content"] if meta_tag else None
+def _is_image_magic(data):
+    # Look at the first bytes of the data for the signature of the image
+    # formats we can upload.
+    head = data[:12]
+    return (
+            head.startswith(b'\xff\xd8\xff') or  # JPEG
+            head.startswith(b'\x89PNG\r\n\x1a\n') or
+            head.startswith((b'GIF87a', b'GIF89a')) or
+            (head.startswith(b'RIFF') and head[8:12] == b'WEBP') or
+            (head[4:8] == b'ftyp' and
+             head[8:12] in _heif_brands))
+
+
+# HEIC/AVIF major brands.
+_heif_brands = frozenset([
+        b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis',
+        b'mif1', b'msf1', b'avif', b'avis'])
+
+
+# Size of the chunks of HTML we parse at a time.
+_HTML_CHUNK_SIZE = 8192
+
+
+def _get_html_encoding(content_type, html_raw):
+    # Use the charset from the Content-Type header, or the one declared in
+    # the document, or assume UTF-8.
+    encoding = None
+    if content_type:
+        msg = email.message.Message()
+        msg['Content-Type'] = content_type
+        encoding = msg.get_content_charset()
+    if not encoding:
+        encoding = bs4.dammit.EncodingDetector.find_declared_encoding(
+                html_raw[:_HTML_CHUNK_SIZE], is_html=True)
+    if encoding:
+        # Keep the declared name, since libxml2 doesn't know about some of
+        # Python's codec names (like euc_jp).
+        encoding = encoding.strip()
+        try:
+            codecs.lookup(encoding)
+            return encoding
+        except LookupError:
+            logger.debug("Unknown document encoding: %s" % encoding)
+    return 'utf-8'
+
+
+class _HtmlHeadParser:
+    """ Collects the <meta> tags and title from the <head> of an HTML
+        document fed to it bit by bit, so we can stop as soon as we're
+        past the <head>.
+    """
+    def __init__(self, encoding='utf-8'):
+        # Contents of the <meta> tags we care about, by property or name.
+        self.metas = {}
+        self.title = None
+        self.done = False
+        self.encoding = encoding
+        self._fed = False
+
+        if has_lxml:
+            try:
+                self._parser = lxml.etree.HTMLPullParser(
+                        events=('end',), tag=('meta', 'title', 'head'),
+                        encoding=encoding)
+            except LookupError:
+                # libxml2 doesn't know this encoding, let it figure it out
+                # from the document.
+                logger.debug("Unsupported document encoding: %s" % encoding)
+                self._parser = lxml.etree.HTMLPullParser(
+                        events=('end',), tag=('meta', 'title', 'head'))
+        else:
+            # Without lxml we accumulate the whole document for
+            # BeautifulSoup.
+            self._parser = None
+            self._chunks = []
+
+    def feed(self, data):
+        # Returns whether we're done with the <head>.
+        if self._parser is None:
+            self._chunks.append(data)
+            return False
+
+        self._fed = True
+        try:
+            self._parser.feed(data)
+            self._readEvents()
+        except lxml.etree.LxmlError as ex:
+            # Give up on the rest of the document, and make do with
+            # whatever we found so far.
+            logger.debug("Error parsing html document: %s" % ex)
+            self.done = True
+        return self.done
+
+    def close(self):
+        if self._parser is None:
+            html_doc = bs4.BeautifulSoup(
+                    b''.join(self._chunks), 'html5lib',
+                    from_encoding=self.encoding)
+            for meta_tag in html_doc.find_all('meta'):
+                self._addMeta(meta_tag.attrs)
+            title_tag = html_doc.find('title')
+            self.title = title_tag.string if title_tag else None
+            self.done = True
+            return
+
+        if not self.done:
+            # lxml complains when closing a parser that didn't get any
+            # elements, like for an empty document.
+            if self._fed:
+                try:
+                    self._parser.close()
+                    self._readEvents()
+                except lxml.etree.LxmlError as ex:
+                    logger.debug("Error parsing html document: %s" % ex)
+            self.done = True
+
+    def _readEvents(self):
+        for _, elem in self._parser.read_events():
+            if self.done:
+                continue
+            if elem.tag == 'meta':
+                self._addMeta(elem.attrib)
+            elif elem.tag == 'title':
+                if self.title is None:
+                    self.title = elem.text
+            elif elem.tag == 'head':
+                self.done = True
+
+    def _addMeta(self, attrs):
+        # The first tag wins if there are several with the same key.
+        key = attrs.get('property') or attrs.get('name')
+        if key in _wanted_metas and key not in self.metas:
+            self.metas[key] = attrs.get('content')
+
+
+# The <meta> tags we look at to build link embeds.
+_wanted_metas = frozenset([
+        'og:title', 'og:description', 'og:image',
+        'twitter:title', 'twitter:description', 'twitter:image',
+        'description', 'thumbnail'])
 
 
 BLUESKY_NETLOC = 'bsky.app'
 
-# Match both links to a profile by name, and by ID
-profile_path_re = re.compile(r'/profile/([\w\d\.]+|(did\:plc\:[\w\d]+))')
+# Links to a profile, by name or by ID, look like this.
+PROFILE_PATH_PREFIX = '/profile/'
 
 
 class BlueskyUrlFlattener(UrlFlattener):
@@ -374,15 +679,18 @@ class BlueskyUrlFlattener(UrlFlattener):
         url = urllib.parse.urlparse(raw_url)
 
         # If this is a Bluesky profile URL, replace it with a mention.
-        if url.netloc == BLUESKY_NETLOC:
-            m = profile_path_re.match(url.path)
-            if m:
-                return '@' + m.group(1)
+        if (url.netloc == BLUESKY_NETLOC and
+                url.path.startswith(PROFILE_PATH_PREFIX)):
+            handle = url.path[len(PROFILE_PATH_PREFIX):].split('/', 1)[0]
+            if handle:
+                return '@' + handle
 
         # Otherwise, keep track of where the URL is so we can add a facet
-        # for it.
+        # for it. atproto requires an http or https scheme.
+        if not raw_url.startswith('http'):
+            raw_url = 'https://' + raw_url
         start = ctx.byte_length
-        end = start + len(text.encode())
+        end = start + utf8_len(text)
         self.urls.append((start, end, raw_url))
 
         # Always keep the text as-is.
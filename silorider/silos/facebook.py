@@ -140,7 +140,7 @@ class FacebookSilo(Silo):
         return self.formatEntry(
                 entry,
                 card_props=CardProps('property', 'og'),
-                profile_url_handlers=ctx.profile_url_handlers)
+                profile_url_handler=ctx.profile_url_handler)
 
     def mediaCallback(self, tmpfile, mt, url, desc):
         with open(tmpfile, 'rb') as fp:
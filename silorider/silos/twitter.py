@@ -108,7 +108,7 @@ class TwitterSilo(Silo):
                 entry,
                 limit=280,
                 card_props=CardProps('name', 'twitter'),
-                profile_url_handlers=ctx.profile_url_handlers,
+                profile_url_handler=ctx.profile_url_handler,
                 url_flattener=TwitterUrlFlattener())
 
     def mediaCallback(self, tmpfile, mt, url, desc):
@@ -1,14 +1,9 @@
 
 def mock_urllib(m):
-    import urllib.request
-    m.setattr(urllib.request, 'urlretrieve', _patched_urlretrieve)
-    m.setattr(urllib.request, 'urlcleanup', _patched_urlcleanup)
+    import silorider.silos.base
+    m.setattr(silorider.silos.base, '_download_media', _patched_download_media)
     return m
 
 
-def _patched_urlretrieve(url, filename=None):
-    return ('/retrieved/' + url.lstrip('/'), None)
-
-
-def _patched_urlcleanup():
-    pass
+def _patched_download_media(url, path):
+    return '/retrieved/' + url.lstrip('/')
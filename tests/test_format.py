@@ -1,6 +1,8 @@
+import io
+import email.message
 import pytest
 from silorider.format import (
-        format_entry, strip_html, HtmlStrippingContext,
+        format_entry, strip_html, shorten_text, HtmlStrippingContext,
         URLMODE_INLINE, URLMODE_LAST, URLMODE_BOTTOM_LIST)
 
 
@@ -28,12 +30,20 @@ def _make_test_entry(best_name, is_micropost):
      "Something"),
     ("<p>Something with <em>emphasis</em> in it</p>",
      "Something with emphasis in it"),
+    ("<h1>Something with <em>emphasis</em>\n<span>in it</span></h1>",
+     "Something with emphasis\nin it"),
+    ("<div>\n  <span>Something</span>\n</div>",
+     "Something"),
     ("<p>Something with <a href=\"http://example.org/blah\">a link</a>",
      "Something with a link http://example.org/blah"),
     ("<p>Something with a link <a href=\"http://example.org/blah\">http://example.org</a>",  # NOQA
      "Something with a link http://example.org/blah"),
     ("<p>Something with <a href=\"http://example.org/first\">one link here</a> and <a href=\"http://example.org/second\">another there</a>...</p>",  # NOQA
-     "Something with one link here http://example.org/first and another there http://example.org/second...")  # NOQA
+     "Something with one link here http://example.org/first and another there http://example.org/second..."),  # NOQA
+    ("<p>100% of <a href=\"http://example.org/blah\">a link</a> at 50%</p>",
+     "100% of a link http://example.org/blah at 50%"),
+    ("<ol><li>First</li><li>Second</li></ol><ul><li>Item</li></ul>",
+     "1. First\n2. Second\n- Item\n")
 ])
 def test_strip_html(text, expected):
     ctx = HtmlStrippingContext()
@@ -111,3 +121,96 @@ def test_format_micropost_entry(text, limit, add_url, expected):
     entry = _make_test_entry(text, True)
     actual = format_entry(entry, limit=limit, add_url=add_url)
     assert actual.text == expected
+
+
+def test_card_info_is_fetched_once(monkeypatch):
+    import urllib.request
+    import silorider.format
+    from silorider.format import CardProps, get_card_info
+
+    fetched = []
+
+    def _patched_urlopen(url):
+        fetched.append(url)
+        return _MockCardResponse(
+            b'<html><head>'
+            b'<meta name="twitter:description" content="A nice blurb">'
+            b'</head><body></body></html>')
+
+    monkeypatch.setattr(urllib.request, 'urlopen', _patched_urlopen)
+    silorider.format._fetch_card_raw.cache_clear()
+    try:
+        entry = _make_test_entry('A test entry', False)
+        props = CardProps('name', 'twitter')
+        for _ in range(3):
+            card = get_card_info(entry, props, HtmlStrippingContext())
+            assert card.text == 'A nice blurb'
+        assert fetched == [test_url]
+    finally:
+        silorider.format._fetch_card_raw.cache_clear()
+
+
+@pytest.mark.parametrize("content_type, raw_html", [
+    # Charset only in the HTTP header.
+    ('text/html; charset=utf-8',
+     '<html><head><meta name="twitter:description" content="Café in naïve Zürich">'
+     '</head><body></body></html>'.encode('utf8')),
+    # No charset anywhere.
+    ('text/html',
+     '<html><head><meta name="twitter:description" content="Café in naïve Zürich">'
+     '</head><body></body></html>'.encode('utf8')),
+    # Charset only in the document.
+    ('text/html',
+     '<html><head><meta charset="iso-8859-1">'
+     '<meta name="twitter:description" content="Café in naïve Zürich">'
+     '</head><body></body></html>'.encode('latin-1')),
+])
+def test_card_info_non_ascii(monkeypatch, content_type, raw_html):
+    import urllib.request
+    import silorider.format
+    from silorider.format import CardProps, get_card_info
+
+    monkeypatch.setattr(
+        urllib.request, 'urlopen',
+        lambda url: _MockCardResponse(raw_html, content_type))
+    silorider.format._fetch_card_raw.cache_clear()
+    try:
+        entry = _make_test_entry('A test entry', False)
+        props = CardProps('name', 'twitter')
+        card = get_card_info(entry, props, HtmlStrippingContext())
+        assert card.text == 'Café in naïve Zürich'
+    finally:
+        silorider.format._fetch_card_raw.cache_clear()
+
+
+class _MockCardResponse(io.BytesIO):
+    def __init__(self, data, content_type='text/html'):
+        super().__init__(data)
+        self.headers = email.message.Message()
+        self.headers['Content-Type'] = content_type
+
+
+def test_best_text_element_is_looked_up_once():
+    entry = _make_test_entry('A test entry', True)
+    finds = []
+    orig_find = entry.htmlFind
+
+    def _counting_find(*args, **kwargs):
+        finds.append(kwargs)
+        return orig_find(*args, **kwargs)
+
+    entry.htmlFind = _counting_find
+    for _ in range(3):
+        assert format_entry(entry).text == 'A test entry'
+    assert finds == [{'class_': 'p-title'}]
+
+
+@pytest.mark.parametrize("text, limit, expected", [
+    ("Short enough.", 20, ("Short enough.", False)),
+    ("First sentence. Second sentence.", 20, ("First sentence.", True)),
+    ("Is it? Yes it is, really.", 10, ("Is it?", True)),
+    ("Version 1. is out. So there.", 12, ("Version 1.", True)),
+    ("No sentence end in here at all", 20, ("No sentence end...", True))
+])
+def test_shorten_text(text, limit, expected):
+    assert shorten_text(text, limit) == expected
@@ -1,5 +1,8 @@
+import types
 import os.path
 import pytest
+import threading
+import urllib3
 from atproto import models as atprotomodels
 from .mockutil import mock_urllib
 
@@ -25,6 +28,7 @@ def test_one_article(cli, feedutil, bskymock):
         'A new article https://example.org/a-new-article',
         None,
         [_make_link_facet('https://example.org/a-new-article', 14, 47)])
+    assert bskymock.fetched_urls == ['https://example.org/a-new-article']
 
 
 def test_one_micropost(cli, feedutil, bskymock):
@@ -43,6 +47,39 @@ def test_one_micropost(cli, feedutil, bskymock):
     assert post == ("This is a quick update.", None, None)
 
 
+def test_session_is_saved(cli, feedutil, bskymock):
+    feed = cli.createTempFeed(feedutil.makeFeed(
+        """<p class="p-name">This is a quick update.</p>
+<a class="u-url" href="/01234.html">permalink</a>"""
+    ))
+
+    cli.appendSiloConfig('test', 'bluesky')
+    cli.setFeedConfig('feed', feed)
+    bskymock.installCredentials(cli, 'test')
+
+    ctx, _ = cli.run('process')
+    assert ctx.silos[0].client.logins == [None]
+    assert ctx.cache.getCustomValue('test_session') == 'TEST_SESSION'
+
+
+def test_session_is_reused(cli, feedutil, bskymock):
+    feed = cli.createTempFeed(feedutil.makeFeed(
+        """<p class="p-name">This is a quick update.</p>
+<a class="u-url" href="/01234.html">permalink</a>"""
+    ))
+
+    cli.appendSiloConfig('test', 'bluesky')
+    cli.setFeedConfig('feed', feed)
+    bskymock.installCredentials(cli, 'test')
+    cli.preExecHook(
+        lambda ctx: ctx.cache.setCustomValue('test_session', 'TEST_SESSION'))
+
+    ctx, _ = cli.run('process')
+    assert ctx.silos[0].client.logins == ['TEST_SESSION']
+    post = ctx.silos[0].client.posts[0]
+    assert post == ("This is a quick update.", None, None)
+
+
 def test_one_micropost_with_one_photo(cli, feedutil, bskymock, monkeypatch):
     feed = cli.createTempFeed(feedutil.makeFeed(
         """<p class="p-name">This is a quick photo update.</p>
@@ -143,6 +180,140 @@ def test_one_micropost_with_links(cli, feedutil, bskymock):
     assert post[2] == [facet]
 
 
+def test_one_micropost_with_profile_links(cli, feedutil, bskymock):
+    cli.appendSiloConfig('test', 'bluesky')
+    bskymock.installCredentials(cli, 'test')
+
+    feed = cli.createTempFeed(feedutil.makeFeed(
+        """<p class="e-content">Hello <a href="https://bsky.app/profile/someone.bsky.social">Someone</a> and <a href="https://bsky.app/profile/did:plc:abc123/post/xyz">Someone Else</a></p>
+<a class="u-url" href="/01234.html">permalink</a>"""))  # NOQA
+    cli.setFeedConfig('feed', feed)
+    ctx, _ = cli.run('process')
+    post = ctx.silos[0].client.posts[0]
+    assert post[0] == "Hello @someone.bsky.social and @did:plc:abc123"
+    assert post[2] == None
+
+
+def test_link_embeds_are_prefetched(cli, feedutil, bskymock):
+    feed = cli.createTempFeed(feedutil.makeFeed(
+        """<p class="e-content">First <a href="http://example.org/one">link</a></p>
+<a class="u-url" href="/01234.html">permalink</a>""",
+        """<p class="e-content">Second <a href="http://example.org/two">link</a></p>
+<a class="u-url" href="/56789.html">permalink</a>"""))  # NOQA
+
+    cli.appendSiloConfig('test', 'bluesky')
+    cli.setFeedConfig('feed', feed)
+    bskymock.installCredentials(cli, 'test')
+    bskymock.embed_infos['http://example.org/one'] = ('One', 'Desc one', None, None)
+    bskymock.embed_infos['http://example.org/two'] = ('Two', 'Desc two', None, None)
+
+    ctx, _ = cli.run('process')
+    assert ctx.cache.wasPosted('test', '/01234.html')
+    assert ctx.cache.wasPosted('test', '/56789.html')
+
+    # Both links were fetched in the background before posting.
+    assert sorted(bskymock.fetched_urls) == [
+        'http://example.org/one', 'http://example.org/two']
+    assert not any(bskymock.fetched_on_main_thread)
+
+    posts = sorted(ctx.silos[0].client.posts, key=lambda p: p[0])
+    assert [(p[0], p[1].external.title, p[1].external.uri) for p in posts] == [
+        ('First link', 'One', 'http://example.org/one'),
+        ('Second link', 'Two', 'http://example.org/two')]
+
+
+def test_link_embeds_are_cached(cli, feedutil, bskymock):
+    feed = cli.createTempFeed(feedutil.makeFeed(
+        """<p class="e-content">First <a href="http://example.org/one">link</a></p>
+<a class="u-url" href="/01234.html">permalink</a>""",
+        """<p class="e-content">Same <a href="http://example.org/one">link</a></p>
+<a class="u-url" href="/56789.html">permalink</a>""",
+        """<p class="e-content">Other <a href="http://example.org/two">link</a></p>
+<a class="u-url" href="/abcde.html">permalink</a>"""))  # NOQA
+
+    cli.appendSiloConfig('test', 'bluesky')
+    cli.setFeedConfig('feed', feed)
+    bskymock.installCredentials(cli, 'test')
+    # Both links have the same thumbnail image.
+    thumb = b'\x89PNG\r\n\x1a\nthumbnail'
+    bskymock.embed_infos['http://example.org/one'] = (
+        'One', 'Desc one', 'http://example.org/thumb.png', thumb)
+    bskymock.embed_infos['http://example.org/two'] = (
+        'Two', 'Desc two', 'http://example.org/thumb.png', thumb)
+
+    ctx, _ = cli.run('process')
+    posts = ctx.silos[0].client.posts
+    assert len(posts) == 3
+    assert sorted(bskymock.fetched_urls) == [
+        'http://example.org/one', 'http://example.org/two']
+    assert ctx.silos[0].client.blob_uploads == [thumb]
+    thumb_blobs = [p[1].external.thumb for p in posts]
+    assert all(b is thumb_blobs[0] for b in thumb_blobs)
+
+
+def test_failed_link_embed_does_not_fail_post(cli, feedutil, bskymock):
+    feed = cli.createTempFeed(feedutil.makeFeed(
+        """<p class="e-content">Broken <a href="http://example.org/one">link</a></p>
+<a class="u-url" href="/01234.html">permalink</a>"""))  # NOQA
+
+    cli.appendSiloConfig('test', 'bluesky')
+    cli.setFeedConfig('feed', feed)
+    bskymock.installCredentials(cli, 'test')
+    bskymock.embed_infos['http://example.org/one'] = (
+        urllib3.exceptions.ProtocolError("Connection aborted."))
+
+    ctx, _ = cli.run('process')
+    assert ctx.cache.wasPosted('test', '/01234.html')
+    post = ctx.silos[0].client.posts[0]
+    assert post == (
+        "Broken link",
+        None,
+        [_make_link_facet('http://example.org/one', 7, 11)])
+
+
+def test_duplicate_entries_are_posted_once(cli, feedutil, bskymock):
+    feed = cli.createTempFeed(feedutil.makeFeed(
+        """<p class="p-name">This is a quick update.</p>
+<a class="u-url" href="/01234.html">permalink</a>""",
+        """<p class="p-name">This is a quick update.</p>
+<a class="u-url" href="/01234.html">permalink</a>"""))
+
+    cli.appendSiloConfig('test', 'bluesky')
+    cli.setFeedConfig('feed', feed)
+    bskymock.installCredentials(cli, 'test')
+
+    ctx, _ = cli.run('process')
+    assert ctx.silos[0].client.posts == [("This is a quick update.", None, None)]
+
+
+def test_bad_entry_does_not_prevent_others(cli, feedutil, bskymock, monkeypatch):
+    feed = cli.createTempFeed(feedutil.makeFeed(
+        """<p class="p-name">This is a bad update.</p>
+<a class="u-url" href="/01234.html">permalink</a>""",
+        """<p class="p-name">This is a good update.</p>
+<a class="u-url" href="/56789.html">permalink</a>"""))
+
+    cli.appendSiloConfig('test', 'bluesky')
+    cli.setFeedConfig('feed', feed)
+    bskymock.installCredentials(cli, 'test')
+
+    import silorider.silos.bluesky
+    orig_get_entry_card = silorider.silos.bluesky.BlueskySilo.getEntryCard
+
+    def _patched_get_entry_card(self, entry, ctx):
+        if entry.get('url') == '/01234.html':
+            raise Exception("Bad entry!")
+        return orig_get_entry_card(self, entry, ctx)
+
+    monkeypatch.setattr(silorider.silos.bluesky.BlueskySilo, 'getEntryCard',
+                        _patched_get_entry_card)
+
+    ctx, _ = cli.run('process')
+    assert not ctx.cache.wasPosted('test', '/01234.html')
+    assert ctx.cache.wasPosted('test', '/56789.html')
+    assert ctx.silos[0].client.posts == [("This is a good update.", None, None)]
+
+
 def test_one_micropost_too_long(cli, feedutil, bskymock):
     cli.appendSiloConfig('test', 'bluesky')
     bskymock.installCredentials(cli, 'test')
@@ -168,11 +339,16 @@ def _patched_media_callback(self, tmpfile, mt, url, desc):
     return self.client.upload_blob(tmpfile, desc)
 
 
-@pytest.fixture(scope='session')
-def bskymock():
-    from silorider.silos.bluesky import BlueskySilo
-    BlueskySilo._CLIENT_CLASS = BlueskyMock
-    return BlueskyMockUtil()
+@pytest.fixture
+def bskymock(monkeypatch):
+    import silorider.silos.bluesky
+    util = BlueskyMockUtil()
+    monkeypatch.setattr(silorider.silos.bluesky.BlueskySilo, '_CLIENT_CLASS',
+                        BlueskyMock)
+    # Don't fetch links over the network to build embeds.
+    monkeypatch.setattr(silorider.silos.bluesky, '_fetch_url_embed_info',
+                        util.fetchUrlEmbedInfo)
+    return util
 
 
 def _make_atproto_image(link, alt="", mime_type="image/jpg", size=100, test_index=None):
@@ -194,20 +370,56 @@ class BlueskyMock:
         self.posts = []
         self.blobs = []
 
-    def login(self, email, password):
-        assert email == 'TEST_EMAIL'
-        assert password == 'TEST_PASSWORD'
+        self.logins = []
+        # Data uploaded with the atproto repo API.
+        self.blob_uploads = []
+        self.com = types.SimpleNamespace(
+                atproto=types.SimpleNamespace(
+                    repo=types.SimpleNamespace(
+                        upload_blob=self._uploadRepoBlob)))
+
+    def login(self, email=None, password=None, session_string=None):
+        if session_string is not None:
+            assert session_string == 'TEST_SESSION'
+        else:
+            assert email == 'TEST_EMAIL'
+            assert password == 'TEST_PASSWORD'
+        self.logins.append(session_string)
+
+    def export_session_string(self):
+        return 'TEST_SESSION'
 
     def upload_blob(self, tmpfile, desc):
         img = _make_atproto_image(tmpfile, test_index=len(self.blobs))
         self.blobs.append((tmpfile, desc))
         return img
 
+    def _uploadRepoBlob(self, data):
+        self.blob_uploads.append(data)
+        img = _make_atproto_image('blob%d' % len(self.blob_uploads))
+        return types.SimpleNamespace(blob=img.image)
+
     def send_post(self, text, post_datetime=None, embed=None, facets=None):
         self.posts.append((text, embed, facets))
 
 
 class BlueskyMockUtil:
+    def __init__(self):
+        # Link embed infos to return, by URL, and the URLs we were asked
+        # to fetch.
+        self.embed_infos = {}
+        self.fetched_urls = []
+        self.fetched_on_main_thread = []
+
+    def fetchUrlEmbedInfo(self, http, url, headers):
+        self.fetched_urls.append(url)
+        self.fetched_on_main_thread.append(
+                threading.current_thread() is threading.main_thread())
+        info = self.embed_infos.get(url)
+        if isinstance(info, Exception):
+            raise info
+        return info
+
     def installCredentials(self, cli, silo_name):
         def do_install_credentials(ctx):
             ctx.cache.setCustomValue(
@@ -218,3 +430,184 @@ class BlueskyMockUtil:
                 'TEST_PASSWORD')
 
         cli.preExecHook(do_install_credentials)
+
+
+class _MockHttpResponse:
+    def __init__(self, chunks, content_type='text/html'):
+        self.chunks = chunks
+        self.headers = {'Content-Type': content_type}
+        self.read_chunks = 0
+
+    def stream(self, amt):
+        for c in self.chunks:
+            self.read_chunks += 1
+            yield c
+
+
+def test_read_empty_html_head():
+    from silorider.silos.bluesky import _read_html_head
+    html_head = _read_html_head(_MockHttpResponse([]))
+    assert html_head.title is None
+    assert html_head.metas == {}
+
+
+def test_read_non_utf8_html_head():
+    from silorider.silos.bluesky import _read_html_head
+    doc = (
+        '<html><head><title>日本語のページ</title>'
+        '<meta property="og:description" content="説明">'
+        '</head><body></body></html>').encode('euc-jp')
+    resp = _MockHttpResponse(
+            [doc[:20], doc[20:]], content_type='text/html; charset=EUC-JP')
+    html_head = _read_html_head(resp)
+    assert html_head.title == '日本語のページ'
+    assert html_head.metas == {'og:description': '説明'}
+
+
+def test_html_head_parser_stops_after_head():
+    from silorider.silos.bluesky import _read_html_head
+    resp = _MockHttpResponse([
+        b'<html><head><title>The title</title>',
+        b'<meta property="og:title" content="OG title">',
+        b'<meta name="twitter:title" content="Twitter title"></head>',
+        b'<body><meta property="og:image" content="nope.jpg">',
+        b'</body></html>'])
+    html_head = _read_html_head(resp)
+    assert html_head.title == 'The title'
+    assert html_head.metas == {
+        'og:title': 'OG title', 'twitter:title': 'Twitter title'}
+    assert resp.read_chunks == 3
+
+
+@pytest.mark.parametrize("content_type, html_raw, expected", [
+    ('text/html; charset=ISO-8859-1', b'', 'iso-8859-1'),
+    ('text/html; charset=EUC-JP', b'<meta charset="utf-8">', 'euc-jp'),
+    ('text/html', b'<meta charset="shift_jis">', 'shift_jis'),
+    ('text/html; charset=bogus', b'', 'utf-8'),
+    (None, b'<html><head>', 'utf-8'),
+])
+def test_get_html_encoding(content_type, html_raw, expected):
+    from silorider.silos.bluesky import _get_html_encoding
+    assert _get_html_encoding(content_type, html_raw) == expected
+
+
+def test_html_head_parser_without_lxml(monkeypatch):
+    import silorider.silos.bluesky
+    monkeypatch.setattr(silorider.silos.bluesky, 'has_lxml', False)
+    resp = _MockHttpResponse(
+        ['<html><head><title>Café</title>'.encode('latin-1'),
+         b'<meta name="description" content="Desc"></head><body></body>'],
+        content_type='text/html; charset=ISO-8859-1')
+    html_head = silorider.silos.bluesky._read_html_head(resp)
+    assert html_head.title == 'Café'
+    assert html_head.metas == {'description': 'Desc'}
+
+
+@pytest.mark.parametrize("data, expected", [
+    (b'\xff\xd8\xff\xe0\x00\x10JFIF', True),
+    (b'\x89PNG\r\n\x1a\n\x00\x00\x00\x0d', True),
+    (b'GIF89a\x01\x00', True),
+    (b'RIFF\x00\x00\x00\x00WEBPVP8 ', True),
+    (b'\x00\x00\x00\x18ftypheic', True),
+    (b'\x00\x00\x00\x1cftypavif', True),
+    (b'BM\x00\x00\x00\x00', False),
+    (b'II*\x00\x08\x00', False),
+    (b'<svg xmlns="http://www.w3.org/2000/svg">', False),
+    (b'', False),
+])
+def test_is_image_magic(data, expected):
+    from silorider.silos.bluesky import _is_image_magic
+    assert _is_image_magic(data) is expected
+
+
+def _make_media_test_silo():
+    from silorider.silos.base import SiloCreationContext
+    from silorider.silos.bluesky import BlueskySilo
+    silo = BlueskySilo(SiloCreationContext(None, None, 'test', sec_items={}))
+    return silo
+
+
+def test_media_callback_uploads_image(bskymock, tmp_path):
+    silo = _make_media_test_silo()
+    tmpfile = tmp_path / 'img.png'
+    tmpfile.write_bytes(b'\x89PNG\r\n\x1a\nimage data')
+    img = silo.mediaCallback(str(tmpfile), 'image/png', '/img.png', 'Desc')
+    assert img.alt == 'Desc'
+    assert silo.client.blob_uploads == [b'\x89PNG\r\n\x1a\nimage data']
+
+
+def test_media_callback_skips_non_image(bskymock, tmp_path):
+    silo = _make_media_test_silo()
+    tmpfile = tmp_path / 'img.bmp'
+    tmpfile.write_bytes(b'BM\x00\x00\x00\x00image data')
+    assert silo.mediaCallback(str(tmpfile), 'image/bmp', '/img.bmp', None) is None
+    assert silo.client.blob_uploads == []
+
+
+def test_media_callback_skips_too_large_image(bskymock, tmp_path):
+    silo = _make_media_test_silo()
+    tmpfile = tmp_path / 'img.png'
+    tmpfile.write_bytes(
+        b'\x89PNG\r\n\x1a\n' + b'\x00' * silo.PHOTO_LIMIT)
+    assert silo.mediaCallback(str(tmpfile), 'image/png', '/img.png', None) is None
+    assert silo.client.blob_uploads == []
+
+
+@pytest.fixture
+def redirect_server():
+    import http.server
+
+    class _Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            hops = int(self.path.strip('/') or 0)
+            if hops > 0:
+                self.send_response(302)
+                self.send_header('Location', '/%d' % (hops - 1))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            body = (
+                b'<html><head><title>Landed</title>'
+                b'<meta property="og:description" content="Final page">'
+                b'</head><body></body></html>')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%d' % server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_fetch_url_embed_info_follows_redirects(redirect_server):
+    from silorider.silos.bluesky import _fetch_url_embed_info, _http
+    info = _fetch_url_embed_info(_http, redirect_server + '/5', {})
+    assert info == ('Landed', 'Final page', None, None)
+
+
+def test_html_head_parser_stops_on_parse_error():
+    lxml = pytest.importorskip('lxml.etree')
+    from silorider.silos.bluesky import _HtmlHeadParser
+
+    class _BrokenParser:
+        def feed(self, data):
+            raise lxml.ParserError("Broken document")
+
+    html_head = _HtmlHeadParser()
+    html_head.feed(b'<html><head><title>The title</title>')
+    html_head._parser = _BrokenParser()
+    assert html_head.feed(b'<meta name="description" content="Desc">')
+    html_head.close()
+    assert html_head.title == 'The title'
+    assert html_head.metas == {}